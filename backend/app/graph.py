@@ -1,15 +1,420 @@
+import asyncio
+import difflib
+import os
 import sqlite3
+import threading
 import logging, re
-from typing import Annotated
+from collections import defaultdict
+from functools import lru_cache
+from typing import Annotated, Literal, Optional
 from typing_extensions import TypedDict
+from pydantic import BaseModel
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, RemoveMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langgraph.checkpoint.memory import InMemorySaver
+from sentence_transformers import SentenceTransformer
+from cachetools import LRUCache, TTLCache
+import hnswlib
+import sqlglot
+from sqlglot import exp as sqlexp
 
 logger = logging.getLogger(__name__)
 
+SCHEMA = """Table: hospitals. Columns: "HOSPITAL NAME" (TEXT), "Address" (TEXT), "CITY" (TEXT), city_norm (TEXT, lowercase city with 'bengaluru' folded to 'bangalore', indexed), name_norm (TEXT, lowercase hospital name, indexed).
+Full-text index: hospitals_fts (FTS5 over the display columns, queried with MATCH)."""
+
+# --- STATIC PROMPT PREFIXES (Built once; cacheable on Gemini's side) ---
+# Each node's prompt is split into an immutable prefix (role + schema + rules)
+# and a small per-turn suffix (remarks, errors, db data). Only the suffix
+# changes between turns, so the prefix can be registered as Gemini cached
+# content and billed/processed once instead of on every call.
+
+ROUTER_PREFIX = """You are Loop AI's intent router. Analyze the user's request.
+1. GREETING: If the user says hello or asks who you are, reply EXACTLY with: 'GREETING: Hello! I am Loop AI, your hospital network voice assistant. How can I help you find a hospital today?'
+2. HANDOFF: Reply with 'HANDOFF: Please hold while I transfer you.'
+3. REJECT: If completely out of scope, reply EXACTLY with: 'REJECT: I'm sorry, I can't help with that. I am forwarding this to a human agent.'
+4. UNCLEAR: If the text is gibberish, reply with 'UNCLEAR: I didn't quite catch that. Could you repeat?'
+5. PAGINATION: If the user asks for "more" or "next" hospitals, reply exactly with 'PAGINATION'
+6. FOLLOW_UP: If the user asks for a detail about a specific item from the previous response... reply with 'SEARCH | Rerun the exact same hospital search...'
+7. SEARCH: Reply with 'SEARCH | <semantic goal>'.
+   CRITICAL: DO NOT write SQL syntax here. Do not use `=` or `WHERE`."""
+
+SQLGEN_PREFIX = f"""You are a SQLite expert. Output ONLY a raw SQL SELECT query. Schema: {SCHEMA}
+
+>>> STRICT LOGIC RULES: <<<
+1. DATA PREFETCHING: ALWAYS use `SELECT *` instead of selecting specific columns, UNLESS the manager instructions specifically ask for a count or total number. If asking for a count, you MUST use `SELECT COUNT(*)`.
+2. AVOID EXACT LONG STRINGS: NEVER filter `WHERE Address LIKE...` using a long, exact address string. It will cause the database to crash. Just filter by Hospital Name or City.
+3. FULL-TEXT SEARCH: Filter names/addresses via the FTS index, NEVER with `=` or `LIKE` scans: `WHERE rowid IN (SELECT rowid FROM hospitals_fts WHERE hospitals_fts MATCH '<keywords>')`. Use bare space-separated keywords (e.g., `MATCH 'Abhay Hospital'`).
+4. CITY FILTERS: Filter cities ONLY on the indexed normalized column with a lowercase prefix match: `city_norm LIKE 'bangalore%'`. Never use aliases or OR — 'bengaluru' is already folded into 'bangalore'.
+5. CLARIFY: If request is too vague, return 'CLARIFY'."""
+
+REPAIR_PREFIX = f"""You are a SQLite repair expert. Your previous query failed.
+Schema: {SCHEMA}
+
+CRITICAL REPAIR RULES:
+1. FUZZY MATCHING: If you are fixing a WHERE clause, ALWAYS use `LIKE '%keyword%'` instead of `=`.
+   (Example: Change `CITY = 'Dwarka'` to `CITY LIKE '%Dwarka%'`).
+2. FTS FALLBACK: If the error involves `hospitals_fts` or `MATCH`, rewrite the filter as plain `LIKE '%keyword%'` scans on the hospitals table instead.
+3. Return ONLY the raw valid SQLite SELECT query. Do not write explanations."""
+
+SYNTH_PREFIX = """You are 'Loop AI', a highly intelligent, empathetic voice assistant working for a hospital network.
+Your job is to translate raw database results into a natural, friendly spoken response.
+
+CRITICAL VOICE RULES:
+1. SOUND HUMAN: Speak naturally using conversational transitions.
+2. NO JARGON: NEVER mention "SQL", "the database", or "tuples".
+3. TTS FORMATTING (IMPORTANT): NEVER use markdown bullet points or asterisks (*). If listing multiple hospitals, use spoken numbers (e.g., "Number one...", "Number two...") or natural transition words (e.g., "First...", "Next...", "Finally...").
+4. EMPATHY ON EMPTY: If the data says 'No results found', say something like: "I'm so sorry, but I couldn't find any hospitals matching that right now."
+5. CONCISENESS (CRITICAL): The database result contains extra pre-fetched data (like full addresses). ONLY read out the specific details the user explicitly asked for. If they only asked for names, DO NOT read the addresses."""
+
+
+# --- FUSED ROUTER (A/B flag) ---
+# One structured-output call that classifies intent AND writes the SQL for
+# search turns, removing a full Gemini round-trip from the common path. On
+# by default; set LOOP_FUSED_ROUTER=0 to fall back to the two-call pipeline
+# (streaming router + speculative SQL generation) for comparison.
+USE_FUSED_ROUTER = os.getenv("LOOP_FUSED_ROUTER", "1") == "1"
+
+FUSED_PREFIX = f"""You are Loop AI's intent router AND SQLite expert, fused into a single step.
+Classify the user's request and, when it is a hospital search, also write the SQL in the same response.
+
+INTENTS:
+- greeting: The user says hello or asks who you are. Set response EXACTLY to: 'Hello! I am Loop AI, your hospital network voice assistant. How can I help you find a hospital today?'
+- handoff: The user asks for a human. Set response to: 'Please hold while I transfer you.'
+- reject: Completely out of scope. Set response EXACTLY to: 'I'm sorry, I can't help with that. I am forwarding this to a human agent.'
+- unclear: The text is gibberish. Set response to: 'I didn't quite catch that. Could you repeat?'
+- pagination: The user asks for "more" or "next" hospitals. Leave sql empty — Python pages deterministically.
+- clarify: A hospital search too vague to run. Leave sql empty.
+- search: A hospital search. Fill `remarks` with the semantic goal and `sql` with the query.
+
+Schema: {SCHEMA}
+
+SQL RULES (search only):
+1. DATA PREFETCHING: ALWAYS use `SELECT *` instead of selecting specific columns, UNLESS the request asks for a count or total number. If asking for a count, you MUST use `SELECT COUNT(*)`.
+2. AVOID EXACT LONG STRINGS: NEVER filter `WHERE Address LIKE...` using a long, exact address string. Just filter by Hospital Name or City.
+3. FULL-TEXT SEARCH: Filter names/addresses via the FTS index, NEVER with `=` or `LIKE` scans: `WHERE rowid IN (SELECT rowid FROM hospitals_fts WHERE hospitals_fts MATCH '<keywords>')`. Use bare space-separated keywords (e.g., `MATCH 'Abhay Hospital'`).
+4. CITY FILTERS: Filter cities ONLY on the indexed normalized column with a lowercase prefix match: `city_norm LIKE 'bangalore%'`. Never use aliases or OR — 'bengaluru' is already folded into 'bangalore'."""
+
+
+class FusedDecision(BaseModel):
+    """Structured output of the fused router + SQL generator call."""
+    intent: Literal["greeting", "reject", "handoff", "unclear", "pagination", "search", "clarify"]
+    response: Optional[str] = None  # spoken reply for greeting/reject/handoff/unclear
+    remarks: Optional[str] = None   # semantic goal for search turns
+    sql: Optional[str] = None       # raw SQLite SELECT for search turns
+
+
+# Precompiled response parsers: one regex pass instead of chained
+# .replace()/.startswith()/.split() scans per LLM reply. This also retires the
+# old .replace("ite", "") fence cleanup, which corrupted any SQL containing
+# the substring "ite" (WHITE, SITE, LITE... in hospital names). Deliberately
+# unanchored: Gemini occasionally wraps the fence in prose ("Here you go:
+# ```sql ..."), which start/end anchors missed.
+_FENCE_RE = re.compile(r"```(?:sqlite|sql)?\s*", re.IGNORECASE)
+_INTENT_RE = re.compile(r"^\s*(GREETING|HANDOFF|REJECT|UNCLEAR|PAGINATION|SEARCH)\b\s*[:|]?\s*(.*)$",
+                        re.IGNORECASE | re.DOTALL)
+
+# Keyset pagination: strip the LIMIT/OFFSET tail of the previous query and
+# seek past the last served rowid instead of OFFSET-scanning old rows.
+_LIMIT_TAIL_RE = re.compile(r"\s+LIMIT\s+\d+(\s+OFFSET\s+\d+)?\s*;?\s*$", re.IGNORECASE)
+_STAR_SELECT_RE = re.compile(r"^\s*SELECT\s+\*\s+FROM\b", re.IGNORECASE)
+_LIMIT_RE = re.compile(r"LIMIT\s+(\d+)", re.IGNORECASE)
+
+
+def _postprocess_sql(raw: str, current_limit: int, current_offset: int, is_pagination: bool) -> dict:
+    """Clean an LLM SQL reply and enforce the LIMIT/bookkeeping invariants in Python."""
+    sql = _FENCE_RE.sub("", raw).strip()
+
+    if sql == "CLARIFY":
+        return {"sql_query": "CLARIFY", "error": None, "retry_count": 0}
+
+    if "SELECT" in sql.upper():
+        sql = sql[sql.upper().find("SELECT"):]
+
+    # --- PYTHON VERIFICATION (Trust, but Verify) ---
+    limit_match = _LIMIT_RE.search(sql)
+    if limit_match is None:
+        logger.warning("\n[SYSTEM] ⚠️ LLM forgot LIMIT. Enforcing via Python.")
+        if is_pagination:
+            sql += f" LIMIT {current_limit} OFFSET {current_offset}"
+        else:
+            sql += f" LIMIT {current_limit}"
+    else:
+        # --- FIX 2: SYNCHRONIZE PYTHON STATE WITH LLM DECISION ---
+        # If the LLM successfully generated 'LIMIT 12', we must update our Python state
+        # so the next pagination jump is 12, not 5.
+        current_limit = int(limit_match.group(1))
+
+    # Save state for the next potential pagination turn
+    return {
+        "sql_query": sql,
+        "error": None,
+        "retry_count": 0,
+        "last_limit": current_limit,
+        "last_offset": current_offset,
+        "last_sql": sql
+    }
+
+
+# Deterministic repair pass: the most common SQL failures (stray `=` instead
+# of fuzzy matching, singular/plural column slips, misspelled identifiers)
+# are trivially diagnosable in Python — no need to pay a Gemini round-trip.
+_EQ_TO_LIKE_RE = re.compile(r"(\"HOSPITAL NAME\"|CITY|Address)\s*=\s*'([^']+)'", re.IGNORECASE)
+_IDENTIFIER_FIXUPS = {"CITIES": "CITY", "HOSPITALS": "hospitals"}
+_NO_SUCH_COLUMN_RE = re.compile(r"no such column:\s*\"?([\w .]+)\"?", re.IGNORECASE)
+_SCHEMA_COLUMNS = ["HOSPITAL NAME", "Address", "CITY", "city_norm", "name_norm"]
+
+
+def _deterministic_repair(sql: str, error: str) -> str:
+    """Apply the cheap, obvious fixes in Python; returns the (possibly unchanged) SQL."""
+    # Rule 1 of the repair prompt, done without the LLM: `=` -> fuzzy LIKE.
+    fixed = _EQ_TO_LIKE_RE.sub(lambda m: f"{m.group(1)} LIKE '%{m.group(2)}%'", sql)
+
+    # Singular/plural slips against this schema.
+    for wrong, right in _IDENTIFIER_FIXUPS.items():
+        fixed = re.sub(rf"\b{wrong}\b", right, fixed, flags=re.IGNORECASE)
+
+    # "no such column: X" -> fuzzy-match X onto the real schema columns.
+    m = _NO_SUCH_COLUMN_RE.search(error)
+    if m:
+        bad = m.group(1).strip()
+        close = difflib.get_close_matches(bad, _SCHEMA_COLUMNS, n=1, cutoff=0.6)
+        if close:
+            quoted = f'"{close[0]}"' if " " in close[0] else close[0]
+            fixed = re.sub(rf'"?{re.escape(bad)}"?', quoted, fixed)
+
+    return fixed
+
+
+def _prune_messages(msgs, keep=4):
+    """Evict all but the last `keep` messages from the checkpointed history.
+
+    add_messages appends forever, so a long phone call grows InMemorySaver
+    state (and its per-turn serialization cost) without bound. Terminal nodes
+    return these RemoveMessage markers alongside their reply to keep the
+    stored transcript O(1) per thread.
+    """
+    return [RemoveMessage(id=m.id) for m in msgs[:-keep] if m.id is not None]
+
+
+def _windowed(msgs, k=4):
+    """Sliding-window memory: send only the last k messages to the LLM.
+
+    Without this every node re-sent the full transcript, so input tokens (and
+    latency and cost) grew linearly with conversation length. The last few
+    turns carry all the context the router and SQL generator actually need.
+    """
+    return msgs[-k:]
+
+
+def _parse_router_output(response: str) -> dict:
+    """Map the raw router reply onto the state update classify_intent_node returns."""
+    m = _INTENT_RE.match(response)
+
+    if m:
+        label, tail = m.group(1).upper(), m.group(2).strip()
+
+        if label == "PAGINATION":
+            return {"intent": "search", "router_remarks": "PAGINATION"}
+
+        if label == "SEARCH":
+            return {"intent": "search", "router_remarks": tail or "Limit to 5 results."}
+
+        # GREETING / UNCLEAR / REJECT reply directly (and loop back to the
+        # user without hanging up); only HANDOFF routes differently.
+        return {
+            "intent": "handoff" if label == "HANDOFF" else "direct",
+            "db_result": tail or response.strip()
+        }
+
+    # THE SAFE FALLBACK: Do not assume search. Assume confusion.
+    logger.warning(f"\n[SYSTEM] ⚠️ Unexpected router output: {response}")
+    return {
+        "intent": "direct",
+        "db_result": "I didn't quite catch that. Are you looking for hospital information?"
+    }
+
+
+def _make_cached_llm(prefix: str):
+    """Register a prompt prefix as Gemini cached content and return an LLM bound to it.
+
+    Returns None if context caching is unavailable (e.g. the prefix is below
+    Gemini's minimum cacheable size), in which case callers inline the prefix.
+    """
+    try:
+        import google.generativeai as genai
+        cache = genai.caching.CachedContent.create(
+            model="models/gemini-2.5-flash",
+            system_instruction=prefix,
+            ttl="300s",
+        )
+        return ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0, cached_content=cache.name)
+    except Exception as e:
+        logger.warning(f"\n[SYSTEM] ⚠️ Prompt cache unavailable ({e}). Falling back to full prompts.")
+        return None
+
+# Single shared Gemini client: module scope keeps the underlying HTTP/2
+# channel (and its TLS handshake) alive across turns and threads.
+llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0)
+
+
+@lru_cache(maxsize=128)
+def _sys_msg(text: str) -> SystemMessage:
+    """Memoized SystemMessage wrapper.
+
+    The static prefixes (router, SQL-gen, repair, synth) are identical every
+    turn; without this each call re-wraps hundreds of tokens of constant
+    prompt into a fresh message object. Dynamic suffixes (remarks, db_data)
+    simply miss and allocate as before.
+    """
+    return SystemMessage(content=text)
+
+
+@lru_cache(maxsize=1)
+def _get_encoder():
+    """Lazily load the MiniLM encoder (seconds of load time, ~100 MB RAM).
+
+    Deferred so importing this module stays cheap; the startup warm task
+    preloads it off-thread so the first semantic lookup doesn't pay the load.
+    """
+    return SentenceTransformer("all-MiniLM-L6-v2")
+
+
+def _encode(text):
+    """Blocking embed (plus first-use model load); run via asyncio.to_thread."""
+    return _get_encoder().encode(text, normalize_embeddings=True)
+
+
+async def warm_llm():
+    """One tiny generation at startup so the first caller's classify step
+    doesn't pay the Gemini TLS handshake and connection setup on top of STT."""
+    try:
+        # Must be a user message: a lone SystemMessage maps to
+        # system_instruction with empty contents, which Gemini rejects.
+        await llm.ainvoke([HumanMessage(content="Reply with OK.")])
+        logger.info("\n[SYSTEM] 🔥 Gemini channel warmed.")
+    except Exception as e:
+        logger.warning(f"\n[SYSTEM] ⚠️ LLM warm-up failed ({e}); first call pays connection setup.")
+    try:
+        await asyncio.to_thread(_get_encoder)
+        logger.info("\n[SYSTEM] 🔥 Sentence encoder preloaded.")
+    except Exception as e:
+        logger.warning(f"\n[SYSTEM] ⚠️ Encoder preload failed ({e}); first semantic lookup loads it.")
+
+# --- PERSISTENT SQLITE CONNECTION (module scope) ---
+# One long-lived read-only handle for the whole process: no per-request file
+# opens, and SQLite's page cache stays warm across turns. Opened lazily since
+# the app's startup hook may create the DB after this module is imported.
+# WAL is a write-side setting and can't be enabled through a read-only handle;
+# mode=ro readers don't block each other anyway.
+_CONN = None
+_CONN_LOCK = threading.Lock()   # guards lazy open
+_QUERY_LOCK = threading.Lock()  # serializes cursor use on the shared handle
+
+
+def _get_conn():
+    global _CONN
+    with _CONN_LOCK:
+        if _CONN is None:
+            _CONN = sqlite3.connect('file:data/hospitals.db?mode=ro&cache=shared',
+                                    uri=True, check_same_thread=False, timeout=5.0)
+            _CONN.execute("PRAGMA busy_timeout = 3000")
+            _CONN.execute("PRAGMA cache_size = -65536")
+            _CONN.execute("PRAGMA mmap_size = 268435456")
+            _CONN.execute("PRAGMA temp_store = MEMORY")
+            _CONN.execute("PRAGMA query_only = ON")
+        return _CONN
+
+
+def _run_query(q, limit=None):
+    """Blocking cursor work, pushed off the event loop via asyncio.to_thread.
+
+    `limit` caps Python-side materialization: fetchall() on a query whose
+    LIMIT clause went missing (e.g. a hand-repaired statement) would happily
+    build tuples for the whole catalog.
+    """
+    conn = _get_conn()
+    with _QUERY_LOCK:
+        cursor = conn.cursor()
+        cursor.execute(q)
+        rows = cursor.fetchmany(limit) if limit else cursor.fetchall()
+        return rows, cursor.description
+
+
+def _validate_select(query: str):
+    """Parse-level allowlist for LLM-generated SQL.
+
+    startswith("SELECT") let `SELECT 1; DROP TABLE hospitals` and CTE-wrapped
+    writes straight through. A real parse rejects anything whose root is not
+    a SELECT or that contains a write/DDL node anywhere in the tree, and
+    returns one canonical spelling so cache keys don't split on whitespace or
+    casing quirks. Returns None when the query is not an acceptable SELECT.
+    (The read-only connection and PRAGMA query_only remain the last line of
+    defense if a hostile query still parses as a SELECT.)
+    """
+    try:
+        tree = sqlglot.parse_one(query, read="sqlite")
+    except sqlglot.errors.ParseError:
+        return None
+    if not isinstance(tree, sqlexp.Select):
+        return None
+    if any(isinstance(node, (sqlexp.Insert, sqlexp.Update, sqlexp.Delete, sqlexp.DDL))
+           for node in tree.walk()):
+        return None
+    return tree.sql(dialect="sqlite")
+
+
+class _TTLBucket(TTLCache):
+    """TTLCache that auto-creates nested dicts, like the defaultdicts it replaces."""
+    def __missing__(self, key):
+        value = defaultdict(dict)
+        self[key] = value
+        return value
+
+
+class BoundedMemorySaver(InMemorySaver):
+    """InMemorySaver with bounded, expiring session storage.
+
+    Twilio call SIDs never repeat, so the stock saver keeps every call's full
+    checkpoint history for the life of the process and RAM grows without
+    bound. Backing the per-thread dicts with a TTLCache caps live sessions
+    and lets idle ones age out; an evicted caller simply starts fresh, which
+    is the right behavior for a phone call that ended half an hour ago.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 1800.0):
+        super().__init__()
+        self.storage = _TTLBucket(maxsize=maxsize, ttl=ttl)
+        self.writes = _TTLBucket(maxsize=maxsize, ttl=ttl)
+        # blobs hold the serialized channel values (the message payloads
+        # themselves — the bulk of per-call memory), one flat entry per
+        # channel version, so a plain TTLCache suffices; scale the bound
+        # since each session produces many versions.
+        self.blobs = TTLCache(maxsize=maxsize * 64, ttl=ttl)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        """Write through, then re-insert this thread's entries to refresh them.
+
+        TTLCache expires a fixed interval after *insertion*, and the base
+        put() mutates buckets in place without re-inserting — left alone,
+        an active call longer than the TTL would lose its state mid-call.
+        Re-inserting on every write makes the TTL measure idleness instead,
+        which is what the eviction rationale assumes.
+        """
+        result = super().put(config, checkpoint, metadata, new_versions)
+        thread_id = config["configurable"]["thread_id"]
+        bucket = self.storage.pop(thread_id, None)
+        if bucket is not None:
+            self.storage[thread_id] = bucket
+        # Blobs for channels untouched in a long call would otherwise expire
+        # out from under the live checkpoint that still references them.
+        for key in [k for k in self.blobs if k[0] == thread_id]:
+            value = self.blobs.pop(key, None)
+            if value is not None:
+                self.blobs[key] = value
+        return result
+
 # --- 1. UPDATED STATE (Added retry_count and intent tracking) ---
 class State(TypedDict):
     messages: Annotated[list, add_messages]
@@ -22,71 +427,208 @@ class State(TypedDict):
     last_limit: int   
     last_offset: int  
     last_sql: str # Python tracks where we left off
+    last_cursor: int # rowid of the last row served (keyset pagination)
+    speculative: bool # This turn's SQL was already produced by a speculative run
 
+@lru_cache(maxsize=1)
 def build_graph():
-    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0)
-    schema = """Table: hospitals. Columns: "HOSPITAL NAME" (TEXT), "Address" (TEXT), "CITY" (TEXT)."""
+    # Memoized: graph compilation, node wiring and the cached-content setup
+    # below are one-time work — callers rebuilding per request get the same
+    # compiled graph (and checkpointer) back for free.
+
+    # One cached-content binding per static prefix; created once per graph
+    # build and dropped permanently the first time an invoke fails — the
+    # CachedContent's 300s TTL makes that failure a certainty, and retrying
+    # a known-dead cache name would add a doomed round-trip to every turn.
+    cached_llms = {
+        "router": _make_cached_llm(ROUTER_PREFIX),
+        "sqlgen": _make_cached_llm(SQLGEN_PREFIX),
+        "repair": _make_cached_llm(REPAIR_PREFIX),
+        "synth": _make_cached_llm(SYNTH_PREFIX),
+    }
+
+    # Outbound LLM concurrency gate: under concurrent phone calls the event
+    # loop happily fans out requests; cap them so we don't blow the Gemini quota.
+    llm_gate = asyncio.Semaphore(16)
+
+    async def _ainvoke_with_prefix(name, prefix, suffix, msgs):
+        """Send only the dynamic suffix when the prefix lives in Gemini's cache.
+
+        The suffix rides as a user part, not a SystemMessage — Gemini rejects
+        a second system instruction when the request already carries cached
+        content. An invoke-time failure (most commonly the CachedContent TTL
+        expiring mid-process) drops the binding for good and falls through to
+        the inline-prefix path, so later turns skip the doomed attempt.
+        """
+        cached_llm = cached_llms.get(name)
+        if cached_llm is not None:
+            user_part = [HumanMessage(content=suffix)] if suffix else []
+            try:
+                async with llm_gate:
+                    return await cached_llm.ainvoke(user_part + msgs)
+            except Exception as e:
+                cached_llms[name] = None
+                logger.warning(f"\n[SYSTEM] ⚠️ Cached prefix '{name}' failed ({e}); dropping it and inlining from now on.")
+        full = prefix + ("\n\n" + suffix if suffix else "")
+        async with llm_gate:
+            return await llm.ainvoke([_sys_msg(full)] + msgs)
+
+    async def _astream_with_prefix(name, prefix, suffix, msgs):
+        """Streaming twin of _ainvoke_with_prefix; the caller holds llm_gate.
+
+        Falls back to the inline prefix only when the cached call dies before
+        yielding anything — after the first chunk a restart would duplicate
+        text downstream, so mid-stream errors propagate (the binding is still
+        dropped so the next turn goes straight to the inline path).
+        """
+        cached_llm = cached_llms.get(name)
+        if cached_llm is not None:
+            user_part = [HumanMessage(content=suffix)] if suffix else []
+            started = False
+            try:
+                async for chunk in cached_llm.astream(user_part + msgs):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                cached_llms[name] = None
+                logger.warning(f"\n[SYSTEM] ⚠️ Cached prefix '{name}' stream failed ({e}); dropping it and inlining from now on.")
+                if started:
+                    raise
+        full = prefix + ("\n\n" + suffix if suffix else "")
+        async for chunk in llm.astream([_sys_msg(full)] + msgs):
+            yield chunk
+
+    # --- SQL RESULT CACHE ---
+    # The catalog is opened read-only, so identical queries always return
+    # identical results; cache the formatted result string keyed by the
+    # whitespace-normalized SQL. Hits skip parse/execute/fetch/format entirely.
+    sql_result_cache = LRUCache(maxsize=512)
+    sql_result_lock = threading.RLock()
+
+    # --- SEMANTIC SQL CACHE (exact LRU first, semantic ANN second, LLM last) ---
+    # Paraphrases ("hospitals in Delhi" / "show Delhi hospitals") should not each
+    # pay the most expensive LLM call in the graph. A cheap local encoder
+    # (lazy-loaded via _get_encoder) plus an in-process ANN index lets
+    # near-duplicate requests reuse SQL verbatim.
+    sql_index = hnswlib.Index(space='cosine', dim=384)
+    sql_index.init_index(max_elements=4096, ef_construction=200, M=16)
+    cached_sqls = []       # position i holds the SQL for index label i
+    # sql -> embedding, written back only after successful execution. LRU-bounded:
+    # failed queries and discarded speculative runs never pop their entry.
+    pending_sql_vecs = LRUCache(maxsize=256)
+
+    async def _semantic_sql_lookup(user_text, remarks):
+        """Return (embedding, cached_sql-or-None) for this request/remarks pair."""
+        v = await asyncio.to_thread(_encode, user_text + "||" + remarks)
+        if cached_sqls:
+            labels, distances = sql_index.knn_query(v, k=1)
+            if 1 - distances[0][0] >= 0.92:
+                return v, cached_sqls[int(labels[0][0])]
+        return v, None
+
+    def _semantic_sql_commit(sql):
+        """Promote a pending (embedding, sql) pair into the ANN index after it executed cleanly."""
+        v = pending_sql_vecs.pop(sql, None)
+        if v is not None and len(cached_sqls) < 4096:
+            sql_index.add_items(v, [len(cached_sqls)])
+            cached_sqls.append(sql)
+
+    # --- SEMANTIC INTENT CACHE ---
+    # Second rung for the router: near-duplicate phrasings ("hello" / "hi
+    # there") that miss the exact-match LRU still resolve without an LLM call.
+    intent_index = hnswlib.Index(space='cosine', dim=384)
+    intent_index.init_index(max_elements=512, ef_construction=200, M=16)
+    cached_intents = []  # position i holds the parsed router output for label i
+
+    def _semantic_intent_lookup(vec):
+        if cached_intents:
+            labels, distances = intent_index.knn_query(vec, k=1)
+            if 1 - distances[0][0] >= 0.9:
+                return dict(cached_intents[int(labels[0][0])])
+        return None
+
+    def _semantic_intent_store(vec, parsed):
+        if len(cached_intents) < 512:
+            intent_index.add_items(vec, [len(cached_intents)])
+            cached_intents.append(parsed)
+
+    # lru_cache can't memoize coroutines, so the exact-match rung is a plain
+    # LRU dict populated after the awaited call. Both classify rungs store
+    # only context-free outcomes: a short follow-up like "what about the
+    # second one?" routes off the previous transcript, and memoizing its
+    # routing process-wide would serve one session's context to another.
+    classify_cache = LRUCache(maxsize=2048)
+
+    def _context_free(parsed):
+        """True for routings that replay identically in any session."""
+        return parsed.get("intent") in ("direct", "handoff") or parsed.get("router_remarks") == "PAGINATION"
 
     # --- NODE 1: INTENT CLASSIFIER (Fix 1) ---
-    def classify_intent_node(state: State):
+    async def classify_intent_node(state: State):
         logger.info("\n\n\n[AGENT] 🧭 Classifying Intent...")
-        
-        prompt = """You are Loop AI's intent router. Analyze the user's request.
-        1. GREETING: If the user says hello or asks who you are, reply EXACTLY with: 'GREETING: Hello! I am Loop AI, your hospital network voice assistant. How can I help you find a hospital today?'
-        2. HANDOFF: Reply with 'HANDOFF: Please hold while I transfer you.'
-        3. REJECT: If completely out of scope, reply EXACTLY with: 'REJECT: I'm sorry, I can't help with that. I am forwarding this to a human agent.'
-        4. UNCLEAR: If the text is gibberish, reply with 'UNCLEAR: I didn't quite catch that. Could you repeat?'
-        5. PAGINATION: If the user asks for "more" or "next" hospitals, reply exactly with 'PAGINATION'
-        6. FOLLOW_UP: If the user asks for a detail about a specific item from the previous response... reply with 'SEARCH | Rerun the exact same hospital search...'
-        7. SEARCH: Reply with 'SEARCH | <semantic goal>'. 
-           CRITICAL: DO NOT write SQL syntax here. Do not use `=` or `WHERE`.
-        """
-        
-        messages = [SystemMessage(content=prompt)] + state["messages"]
-        response = llm.invoke(messages).content.strip()
-        response_upper = response.upper()
 
-        if response_upper.startswith("GREETING"):
-            clean_res = response.split(":", 1)[1].strip() if ":" in response else response
-            return {"intent": "direct", "db_result": clean_res}
-            
-        elif response_upper.startswith("HANDOFF"):
-            clean_res = response.split(":", 1)[1].strip() if ":" in response else response
-            return {"intent": "handoff", "db_result": clean_res}
-        
-        elif response_upper.startswith("UNCLEAR"):
-            clean_res = response.split(":", 1)[1].strip() if ":" in response else response
-            # This loops back to the user without hanging up
-            return {"intent": "direct", "db_result": clean_res}
-            
-        elif response_upper.startswith("REJECT"):
-            # This will now perfectly extract the exact assignment phrase
-            clean_res = response.split(":", 1)[1].strip() if ":" in response else response
-            return {"intent": "direct", "db_result": clean_res}
-            
-        elif response_upper.startswith("PAGINATION"):
-            return {"intent": "search", "router_remarks": "PAGINATION"}
-            
-        elif response_upper.startswith("SEARCH"):
-            remarks = response.split("|", 1)[1].strip() if "|" in response else "Limit to 5 results."
-            return {"intent": "search", "router_remarks": remarks}
-            
-        else:
-            # THE SAFE FALLBACK: Do not assume search. Assume confusion.
-            logger.warning(f"\n[SYSTEM] ⚠️ Unexpected router output: {response}")
-            return {
-                "intent": "direct", 
-                "db_result": "I didn't quite catch that. Are you looking for hospital information?"
-            }
-        
+        # Exact-match cache: voice traffic is dominated by short repeat utterances
+        # ("yes", "more", "hi") — those resolve with a dict lookup instead of a
+        # Gemini round-trip. Longer free-form requests skip the cache to avoid
+        # polluting it with one-off phrasings.
+        last = state["messages"][-1].content.strip().lower()
+        cacheable = len(last) <= 64
+        if cacheable:
+            hit = classify_cache.get(last)
+            if hit is not None:
+                return dict(hit)
+
+        # Semantic rung: paraphrases of an already-routed utterance reuse its
+        # parsed outcome at sub-millisecond cost.
+        vec = await asyncio.to_thread(_encode, last)
+        hit = _semantic_intent_lookup(vec)
+        if hit is not None:
+            logger.info("\n[SYSTEM] ⚡ Semantic intent cache hit.")
+            return hit
+
+        # Speculative execution: stream the router and, the moment the partial
+        # output reveals a SEARCH, start SQL generation in parallel with the
+        # rest of the classifier stream. This overlaps one Gemini round-trip
+        # with another on the common search path.
+        buf = ""
+        spec_task = None
+        spec_remarks = None
+        async with llm_gate:
+            async for chunk in _astream_with_prefix("router", ROUTER_PREFIX, "", _windowed(state["messages"])):
+                buf += chunk.content or ""
+                if spec_task is None and buf.strip().upper().startswith("SEARCH"):
+                    spec_remarks = buf.split("|", 1)[1].strip() if "|" in buf else "Limit to 5 results."
+                    spec_task = asyncio.create_task(generate_sql_node({**state, "router_remarks": spec_remarks}))
+
+        parsed = _parse_router_output(buf.strip())
+        if _context_free(parsed):
+            if cacheable:
+                classify_cache[last] = parsed
+            _semantic_intent_store(vec, parsed)
+
+        if spec_task is not None:
+            # Only trust the speculation if the router settled on the same
+            # remarks it saw mid-stream; otherwise discard and run normally.
+            if parsed.get("intent") == "search" and parsed.get("router_remarks") == spec_remarks:
+                logger.info("\n[SYSTEM] ⚡ Speculative SQL generation hit.")
+                return {**parsed, **(await spec_task), "speculative": True}
+            spec_task.cancel()
+
+        return parsed
+
 
     # --- NODE 2: DIRECT RESPONSE (Handles Greeting/Rejection) ---
     def direct_response_node(state: State):
         logger.info("\n[AGENT] 🗣️ Replying directly (Greeting/Out of Scope)")
-        return {"messages": [AIMessage(content=state["db_result"])]}
+        return {"messages": _prune_messages(state["messages"]) + [AIMessage(content=state["db_result"])]}
 
     # --- NODE 3: SQL GENERATOR ---
-    def generate_sql_node(state: State):
+    async def generate_sql_node(state: State):
+        # The classifier's speculative run already produced this turn's SQL.
+        if state.get("speculative"):
+            return {"speculative": False}
+
         remarks = state.get("router_remarks", "")
         
         # --- DETERMINISTIC STATE TRACKING ---
@@ -95,129 +637,243 @@ def build_graph():
         
         # Defensive string matching
         is_pagination = "PAGINATION" in remarks.strip().upper()
-        
+
+        # Semantic cache: paraphrased repeats reuse proven SQL without an LLM call.
+        # Pagination turns are excluded — their SQL depends on offset state.
+        sem_vec = None
+        if not is_pagination:
+            user_text = state["messages"][-1].content
+            sem_vec, cached_sql = await _semantic_sql_lookup(user_text, remarks)
+            if cached_sql:
+                logger.info(f"\n[SYSTEM] ⚡ Semantic SQL cache hit: {cached_sql}")
+                limit_match = _LIMIT_RE.search(cached_sql)
+                return {
+                    "sql_query": cached_sql,
+                    "error": None,
+                    "retry_count": 0,
+                    "last_limit": int(limit_match.group(1)) if limit_match else current_limit,
+                    "last_offset": 0,
+                    "last_sql": cached_sql
+                }
+
         if is_pagination and last_sql:
+            # Keyset pagination: seek past the last served rowid in O(log N)
+            # instead of making SQLite scan-and-discard OFFSET rows. No LLM
+            # call — the next page is fully determined by Python state.
+            last_cursor = state.get("last_cursor", 0)
+            base = _LIMIT_TAIL_RE.sub("", last_sql).rstrip().rstrip(";")
+            if last_cursor and _STAR_SELECT_RE.match(base) and "ORDER BY" not in base.upper():
+                connector = "AND" if " WHERE " in base.upper() else "WHERE"
+                sql = f"{base} {connector} rowid > {last_cursor} ORDER BY rowid LIMIT {current_limit}"
+                logger.info(f"\n[SYSTEM] 📄 Keyset pagination: {sql}")
+                return {
+                    "sql_query": sql,
+                    "error": None,
+                    "retry_count": 0,
+                    "last_limit": current_limit,
+                    "last_offset": state.get("last_offset", 0) + current_limit,
+                    "last_sql": base  # keep the cursor clause out of the stored base
+                }
+
+            # Fallback for cursor-less or ORDER BY queries: patch LIMIT/OFFSET
+            # in Python. Either way the next page is fully determined by state,
+            # so pagination turns never pay a Gemini round-trip.
             current_offset = state.get("last_offset", 0) + current_limit
-            injected_instruction = f"""
-            User wants the NEXT page of results. 
-            Modify this exact previous query:
-            {last_sql}
-            
-            STRICTLY apply LIMIT {current_limit} OFFSET {current_offset}.
-            Do NOT change the base WHERE clauses.
-            """
-        else:
-            current_offset = 0
-            # FIX 1: Tell the LLM to use our default 5 ONLY IF the user didn't specify a number
-            injected_instruction = f"Manager Instructions: {remarks}. Apply LIMIT {current_limit} UNLESS the manager instructions specify a different limit."
-            
+            sql = f"{base} LIMIT {current_limit} OFFSET {current_offset}"
+            logger.info(f"\n[SYSTEM] 📄 Offset pagination: {sql}")
+            return {
+                "sql_query": sql,
+                "error": None,
+                "retry_count": 0,
+                "last_limit": current_limit,
+                "last_offset": current_offset,
+                "last_sql": base
+            }
+
+        current_offset = 0
+        # FIX 1: Tell the LLM to use our default 5 ONLY IF the user didn't specify a number
+        injected_instruction = f"Manager Instructions: {remarks}. Apply LIMIT {current_limit} UNLESS the manager instructions specify a different limit."
+
         logger.info(f"\n[AGENT] 🤖 SQL Generator thinking: {injected_instruction}")
-        
-        prompt = f"""You are a SQLite expert. Output ONLY a raw SQL SELECT query. Schema: {schema}
-        
-        >>> INSTRUCTIONS FOR THIS TURN: <<<
-        {injected_instruction}
-        
-        >>> STRICT LOGIC RULES: <<<
-        1. DATA PREFETCHING: ALWAYS use `SELECT *` instead of selecting specific columns, UNLESS the manager instructions specifically ask for a count or total number. If asking for a count, you MUST use `SELECT COUNT(*)`.
-        2. AVOID EXACT LONG STRINGS: NEVER filter `WHERE Address LIKE...` using a long, exact address string. It will cause the database to crash. Just filter by Hospital Name or City.
-        3. EXTREME FUZZY MATCHING: You MUST ALWAYS use `LIKE '%keyword%'`. NEVER use `=`. Replace spaces with `%` (e.g., `"HOSPITAL NAME" LIKE '%Abhay%Hospital%'`).
-        4. CITY ALIASES: For "Bangalore", check `(CITY LIKE '%Bangalore%' OR CITY LIKE '%Bengaluru%')`.
-        5. CLARIFY: If request is too vague, return 'CLARIFY'.
-        """
 
-        messages = [SystemMessage(content=prompt)] + state["messages"]
-        response = llm.invoke(messages)
-        sql = response.content.replace("```sql", "").replace("```", "").replace("ite", "").strip()
-        
-        if sql == "CLARIFY":
-            return {"sql_query": "CLARIFY", "error": None, "retry_count": 0}
-            
-        if "SELECT" in sql.upper():
-            sql = sql[sql.upper().find("SELECT"):]
-            
-        # --- PYTHON VERIFICATION (Trust, but Verify) ---
-        if "LIMIT" not in sql.upper():
-            logger.warning("\n[SYSTEM] ⚠️ LLM forgot LIMIT. Enforcing via Python.")
-            if is_pagination:
-                sql += f" LIMIT {current_limit} OFFSET {current_offset}"
-            else:
-                sql += f" LIMIT {current_limit}"
-                
-        # --- FIX 2: SYNCHRONIZE PYTHON STATE WITH LLM DECISION ---
-        # If the LLM successfully generated 'LIMIT 12', we must update our Python state
-        # so the next pagination jump is 12, not 5.
-        limit_match = re.search(r'LIMIT\s+(\d+)', sql.upper())
-        if limit_match:
-            current_limit = int(limit_match.group(1))
-                
-        # Save state for the next potential pagination turn
-        return {
-            "sql_query": sql, 
-            "error": None, 
-            "retry_count": 0,
-            "last_limit": current_limit,
-            "last_offset": current_offset,
-            "last_sql": sql
-        }
+        suffix = f">>> INSTRUCTIONS FOR THIS TURN: <<<\n{injected_instruction}"
+        response = await _ainvoke_with_prefix("sqlgen", SQLGEN_PREFIX, suffix, _windowed(state["messages"]))
+        result = _postprocess_sql(response.content, current_limit, current_offset, is_pagination)
+
+        # Stage for the semantic cache; committed once the query executes cleanly.
+        if sem_vec is not None and result["sql_query"] != "CLARIFY":
+            pending_sql_vecs[result["sql_query"]] = sem_vec
+
+        return result
+
+    # --- NODE 3b: FUSED ROUTER + SQL GENERATOR (single LLM call) ---
+    fused_llm = llm.with_structured_output(FusedDecision)
+
+    # Exact-match rung for the fused call, mirroring classify_cache in the
+    # legacy pipeline: voice traffic is dominated by short repeat utterances
+    # ("hi", "more", "thanks"), and only context-free decisions are stored,
+    # so a hit replays safely in any session.
+    fused_cache = LRUCache(maxsize=2048)
+
+    def _apply_fused_decision(decision, state):
+        """Map a FusedDecision onto the state update fused_router_node returns."""
+        if decision.intent in ("greeting", "reject", "unclear"):
+            return {"intent": "direct", "db_result": decision.response or "I didn't quite catch that. Could you repeat?"}
+
+        if decision.intent == "handoff":
+            return {"intent": "handoff", "db_result": decision.response or "Please hold while I transfer you."}
+
+        if decision.intent == "pagination":
+            # Deterministic pagination bookkeeping lives in generate_sql_node.
+            # Reset sql_query so a stale CLARIFY from the previous turn can't
+            # misroute this one in route_fused.
+            return {"intent": "search", "router_remarks": "PAGINATION", "sql_query": ""}
+
+        if decision.intent == "clarify" or not decision.sql:
+            # Clear router_remarks explicitly: add_messages-style state merging
+            # would otherwise keep "PAGINATION" from a previous turn and route
+            # this clarify into the deterministic pagination path.
+            return {"intent": "search", "sql_query": "CLARIFY", "error": None,
+                    "retry_count": 0, "router_remarks": ""}
+
+        result = _postprocess_sql(decision.sql, state.get("last_limit", 5), 0, False)
+        result["intent"] = "search"
+        result["router_remarks"] = decision.remarks or ""
+        return result
+
+    async def fused_router_node(state: State):
+        logger.info("\n\n\n[AGENT] 🧭⚡ Fused routing + SQL generation...")
+
+        user_text = str(state["messages"][-1].content)
+        text_norm = " ".join(user_text.lower().split())
+
+        # Rung 1: exact cache — repeat short utterances resolve with a dict
+        # lookup instead of a structured-output round-trip.
+        if len(text_norm) <= 64:
+            hit = fused_cache.get(text_norm)
+            if hit is not None:
+                logger.info("\n[SYSTEM] ⚡ Fused decision cache hit.")
+                return _apply_fused_decision(hit, state)
+
+        # Rung 2: semantic SQL cache — paraphrases of a proven search reuse
+        # its SQL verbatim, same as the legacy generate path.
+        sem_vec, cached_sql = await _semantic_sql_lookup(user_text, "")
+        if cached_sql:
+            logger.info(f"\n[SYSTEM] ⚡ Semantic SQL cache hit: {cached_sql}")
+            limit_match = _LIMIT_RE.search(cached_sql)
+            return {
+                "intent": "search",
+                "router_remarks": "",
+                "sql_query": cached_sql,
+                "error": None,
+                "retry_count": 0,
+                "last_limit": int(limit_match.group(1)) if limit_match else state.get("last_limit", 5),
+                "last_offset": 0,
+                "last_sql": cached_sql
+            }
+
+        messages = [_sys_msg(FUSED_PREFIX)] + _windowed(state["messages"])
+        async with llm_gate:
+            decision = await fused_llm.ainvoke(messages)
+
+        # Searches and clarifies can depend on the transcript (follow-ups),
+        # so only context-free intents are memoized.
+        if len(text_norm) <= 64 and decision.intent in ("greeting", "reject", "unclear", "handoff", "pagination"):
+            fused_cache[text_norm] = decision
+
+        result = _apply_fused_decision(decision, state)
+        if decision.intent == "search" and result.get("sql_query") not in (None, "", "CLARIFY"):
+            # Stage for the semantic cache; committed once the query executes cleanly.
+            pending_sql_vecs[result["sql_query"]] = sem_vec
+        return result
 
     # --- NODE 4: SQL EXECUTOR (Fix 2, 6, 7: Security, Formatting, Timeouts) ---
-    def execute_sql_node(state: State):
+    async def execute_sql_node(state: State):
         query = state["sql_query"]
         logger.info(f"\n[SYSTEM] ⚙️ Executing SQL: {query}")
         
-        # Fix 2: SQL Injection / Mutation Prevention
-        if not query.upper().startswith("SELECT"):
+        # Fix 2: SQL Injection / Mutation Prevention — parse-level allowlist
+        # instead of a prefix check that chained statements could sneak past.
+        query = _validate_select(query)
+        if query is None:
             logger.error("\n[SYSTEM] 🛑 SECURITY BLOCK: Non-SELECT query detected.")
             return {"error": "Only SELECT queries are allowed.", "db_result": None}
-            
+
+        cache_key = " ".join(query.upper().split())
+        with sql_result_lock:
+            cached = sql_result_cache.get(cache_key)
+        if cached is not None:
+            logger.info("\n[SYSTEM] ⚡ SQL result cache hit.")
+            cached_str, cached_cursor = cached
+            return {"db_result": cached_str, "error": None, "last_cursor": cached_cursor}
+
         try:
-            # Fix 7: Timeouts
-            conn = sqlite3.connect('file:data/hospitals.db?mode=ro', uri=True, timeout=5.0)
-            cursor = conn.cursor()
-            
-            # Additional PRAGMA safeguard
-            conn.execute("PRAGMA busy_timeout = 3000")
-            
-            cursor.execute(query)
-            results = cursor.fetchall()
-            
-            # Fix 6: Dictionary formatting
+            # Surface rowid on star queries so the next page can seek with
+            # WHERE rowid > cursor instead of re-scanning OFFSET rows.
+            exec_query = _STAR_SELECT_RE.sub("SELECT rowid, * FROM", query)
+            limit_match = _LIMIT_RE.search(query)
+            row_bound = int(limit_match.group(1)) if limit_match else state.get("last_limit", 5)
+            results, description = await asyncio.to_thread(_run_query, exec_query, row_bound)
+
+            columns = [desc[0] for desc in description] if description else []
+            last_cursor = 0
+            if results and columns and columns[0] == "rowid":
+                last_cursor = results[-1][0]
+                columns = columns[1:]
+                results = [row[1:] for row in results]
+
+            # The *_norm search columns just duplicate the display columns in
+            # lowercase — keep them out of the synthesizer's prompt tokens.
+            if any(c.endswith("_norm") for c in columns):
+                keep = [i for i, c in enumerate(columns) if not c.endswith("_norm")]
+                columns = [columns[i] for i in keep]
+                results = [tuple(row[i] for i in keep) for row in results]
+
+            # Fix 6: Compact formatting — a pipe-delimited table costs the
+            # synthesizer LLM far fewer tokens than a repr'd list of dicts,
+            # and skips building the intermediate dicts entirely.
             if results:
-                columns = [desc[0] for desc in cursor.description]
-                formatted = [dict(zip(columns, row)) for row in results]
-                result_str = str(formatted)
+                if len(results) == 1 and len(columns) == 1 and columns[0].upper().startswith("COUNT"):
+                    result_str = f"COUNT={results[0][0]}"
+                else:
+                    header = " | ".join(columns)
+                    rows = "\n".join(" | ".join("" if v is None else str(v) for v in row) for row in results)
+                    result_str = header + "\n" + rows
             else:
                 result_str = "No results found."
-                
-            conn.close()
-            return {"db_result": result_str, "error": None}
+
+            with sql_result_lock:
+                sql_result_cache[cache_key] = (result_str, last_cursor)
+            # Commit under the raw post-processed SQL — that's the key
+            # generate_sql_node staged the embedding with; `query` was
+            # reassigned to sqlglot's canonical rendering above.
+            _semantic_sql_commit(state["sql_query"])
+            return {"db_result": result_str, "error": None, "last_cursor": last_cursor}
             
         except Exception as e:
+            # A failed query never commits its embedding; drop the staged one.
+            pending_sql_vecs.pop(state["sql_query"], None)
             return {"error": str(e), "db_result": None}
 
     # --- NODE 5: ERROR REPAIR (Fix 3: Bounded Reflection) ---
-    def repair_sql_node(state: State):
+    async def repair_sql_node(state: State):
         logger.info(f"\n[AGENT] 🔧 Repair Agent fixing SQL (Attempt {state['retry_count'] + 1})...")
-        prompt = f"""You are a SQLite repair expert. Your previous query failed.
-        Schema: {schema}
-        Bad Query: {state['sql_query']}
-        Error Message: {state['error']}
-        
-        CRITICAL REPAIR RULES:
-        1. FUZZY MATCHING: If you are fixing a WHERE clause, ALWAYS use `LIKE '%keyword%'` instead of `=`. 
-           (Example: Change `CITY = 'Dwarka'` to `CITY LIKE '%Dwarka%'`).
-        2. Return ONLY the raw valid SQLite SELECT query. Do not write explanations.
-        """
-        
-        messages = [SystemMessage(content=prompt)] + state["messages"]
-        response = llm.invoke(messages)
-        sql = response.content.replace("```sql", "").replace("```", "").strip()
+
+        # Cheap deterministic fixups first; only fall through to the LLM when
+        # Python couldn't change anything about the query.
+        fixed = _deterministic_repair(state["sql_query"], state["error"] or "")
+        if fixed != state["sql_query"]:
+            logger.info(f"\n[SYSTEM] 🔧 Deterministic repair applied: {fixed}")
+            return {"sql_query": fixed, "error": None, "retry_count": state["retry_count"] + 1}
+
+        suffix = f"Bad Query: {state['sql_query']}\nError Message: {state['error']}"
+        response = await _ainvoke_with_prefix("repair", REPAIR_PREFIX, suffix, _windowed(state["messages"]))
+        sql = _FENCE_RE.sub("", response.content).strip()
         
         return {"sql_query": sql, "error": None, "retry_count": state["retry_count"] + 1}
 
             # --- NODE 6: SYNTHESIZER (The Human Voice) ---
-    def synthesize_node(state: State):
+    async def synthesize_node(state: State):
         
         # FIX 1: Check if this is the very first turn of the conversation
         is_first_turn = len(state["messages"]) == 1
@@ -226,35 +882,29 @@ def build_graph():
             intro_rule = "CRITICAL: This is the first interaction. You MUST start your response by saying 'Hello, I am Loop AI...'"
         
         if state.get("sql_query") == "CLARIFY":
-            prompt = f"""You are 'Loop AI', a warm and helpful voice assistant. 
-            {intro_rule}
-            The user's request was a bit too vague to search. 
+            suffix = f"""{intro_rule}
+            The user's request was a bit too vague to search.
             Politely ask them to clarify which city or specific hospital name they are looking for."""
-        
+
         else:
             db_data = state.get('db_result', 'No results found.')
-            prompt = f"""You are 'Loop AI', a highly intelligent, empathetic voice assistant working for a hospital network.
-            Your job is to translate raw database results into a natural, friendly spoken response.
-            
-            >>> RAW DATABASE RESULT: {db_data} <<<
-            
-            CRITICAL VOICE RULES:
-            1. {intro_rule}
-            2. SOUND HUMAN: Speak naturally using conversational transitions.
-            3. NO JARGON: NEVER mention "SQL", "the database", or "tuples". 
-            4. TTS FORMATTING (IMPORTANT): NEVER use markdown bullet points or asterisks (*). If listing multiple hospitals, use spoken numbers (e.g., "Number one...", "Number two...") or natural transition words (e.g., "First...", "Next...", "Finally...").
-            5. EMPATHY ON EMPTY: If the data says 'No results found', say something like: "I'm so sorry, but I couldn't find any hospitals matching that right now."
-            6. CONCISENESS (CRITICAL): The database result contains extra pre-fetched data (like full addresses). ONLY read out the specific details the user explicitly asked for. If they only asked for names, DO NOT read the addresses.
-            """
-        
-        messages = [SystemMessage(content=prompt), state["messages"][-1]]
-        response = llm.invoke(messages)
-        return {"messages": [response]}
-        
+            suffix = f"""{intro_rule}
+            >>> RAW DATABASE RESULT: {db_data} <<<"""
 
-    def synthesize_failure_node(state: State):
+        # Stream the reply token-by-token so downstream consumers (TTS) can
+        # start speaking after the first few tokens instead of waiting for the
+        # whole message; callers pick the deltas up via astream_events /
+        # stream_mode="messages".
+        response = None
+        async with llm_gate:
+            async for chunk in _astream_with_prefix("synth", SYNTH_PREFIX, suffix, [state["messages"][-1]]):
+                response = chunk if response is None else response + chunk
+        return {"messages": _prune_messages(state["messages"]) + [response]}
+
+
+    async def synthesize_failure_node(state: State):
         msg = "I'm having trouble accessing the database right now. Please try again."
-        return {"messages": [AIMessage(content=msg)]}
+        return {"messages": _prune_messages(state["messages"]) + [AIMessage(content=msg)]}
 
     # --- ROUTING LOGIC ---
     def route_intent(state: State):
@@ -265,6 +915,18 @@ def build_graph():
         return "direct_response" # Ultimate safety catch
 
 
+    def route_fused(state: State):
+        if state["intent"] in ["direct", "handoff"]:
+            return "direct_response"
+        # CLARIFY before PAGINATION: sql_query is set fresh by every fused
+        # decision, while router_remarks merges across turns.
+        if state.get("sql_query") == "CLARIFY":
+            return "synthesize"    # ask the user for details
+        if state.get("router_remarks") == "PAGINATION":
+            return "generate_sql"  # deterministic pagination path
+        return "execute_sql"       # SQL already produced in the fused call
+
+
     def route_execution(state: State):
         if state["sql_query"] == "CLARIFY":
             return "synthesize" # Let the synthesizer ask the user for details
@@ -278,7 +940,6 @@ def build_graph():
     # --- BUILD THE GRAPH ---
     workflow = StateGraph(State)
     
-    workflow.add_node("classify_intent", classify_intent_node)
     workflow.add_node("direct_response", direct_response_node)
     workflow.add_node("generate_sql", generate_sql_node)
     workflow.add_node("execute_sql", execute_sql_node)
@@ -286,9 +947,15 @@ def build_graph():
     workflow.add_node("synthesize", synthesize_node)
     workflow.add_node("synthesize_failure", synthesize_failure_node)
     
-    workflow.add_edge(START, "classify_intent")
-    workflow.add_conditional_edges("classify_intent", route_intent)
-    
+    if USE_FUSED_ROUTER:
+        workflow.add_node("fused_router", fused_router_node)
+        workflow.add_edge(START, "fused_router")
+        workflow.add_conditional_edges("fused_router", route_fused)
+    else:
+        workflow.add_node("classify_intent", classify_intent_node)
+        workflow.add_edge(START, "classify_intent")
+        workflow.add_conditional_edges("classify_intent", route_intent)
+
     workflow.add_edge("direct_response", END)
     
     workflow.add_edge("generate_sql", "execute_sql")
@@ -299,5 +966,5 @@ def build_graph():
     workflow.add_edge("synthesize", END)
     workflow.add_edge("synthesize_failure", END)
     
-    memory = InMemorySaver()
+    memory = BoundedMemorySaver(maxsize=1024, ttl=1800)
     return workflow.compile(checkpointer=memory)
\ No newline at end of file
@@ -1,20 +1,22 @@
 # backend/app/main.py
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from langchain_core.messages import HumanMessage
 from contextlib import asynccontextmanager
 from twilio.twiml.voice_response import VoiceResponse, Gather, Dial
-import os, logging
-import tempfile
+import asyncio
+import io
+import os, logging, re
+import wave
+import av
 import speech_recognition as sr
 from gtts import gTTS
-from pydub import AudioSegment
 from dotenv import load_dotenv
 load_dotenv()
 
-from app.graph import build_graph
-from app.tools import setup_database
+from app.graph import build_graph, warm_llm
+from app.tools import setup_database, database_is_current
 
 # Configure the logger to show timestamps and severity levels
 logging.basicConfig(
@@ -23,12 +25,32 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Local neural TTS: piper synthesizes on-CPU straight into a buffer, removing
+# the gTTS round-trip to Google (often 300-800 ms per sentence). Falls back
+# to gTTS when no voice model is installed.
+try:
+    from piper.voice import PiperVoice
+    _piper = PiperVoice.load(os.getenv("PIPER_VOICE", "en_US-amy-low.onnx"))
+    _TTS_MEDIA_TYPE = "audio/wav"
+    logger.info("Piper TTS voice loaded; synthesizing locally.")
+except Exception:
+    _piper = None
+    _TTS_MEDIA_TYPE = "audio/mpeg"
+    logger.info("Piper voice unavailable; falling back to gTTS.")
+
 # --- 1. Startup Event ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    if not os.path.exists("data/hospitals.db"):
+    # Re-ingest when the DB is missing OR was built by an older ingest: the
+    # SQL prompts require city_norm/name_norm and hospitals_fts, so a stale
+    # checkout DB would make every search fail on nonexistent columns.
+    if not os.path.exists("data/hospitals.db") or not database_is_current():
         logger.info("Initializing SQLite database...")
-        setup_database("data/hospitals.csv") 
+        setup_database("data/hospitals.csv")
+    # Warm the Gemini channel in the background while the server finishes
+    # booting, so the first caller's STT and classify don't stack on top of
+    # a cold TLS handshake.
+    asyncio.create_task(warm_llm())
     yield
 
 app = FastAPI(title="Loop AI Voice Backend", lifespan=lifespan)
@@ -43,6 +65,52 @@ app.add_middleware(
 
 agent_graph = build_graph()
 
+# Sentence boundaries for the streaming TTS pipeline.
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+
+# Shared recognizer: constructing one per request repaid its setup every
+# time, and the browser sends pre-trimmed clips so dynamic ambient-energy
+# adjustment never has anything to calibrate on — pin the thresholds once.
+_recognizer = sr.Recognizer()
+_recognizer.energy_threshold = 300
+_recognizer.dynamic_energy_threshold = False
+
+
+def _msg_text(raw_content):
+    """Flatten an LLM message's content (string or block list) to plain text."""
+    if isinstance(raw_content, list):
+        return "".join([block.get("text", "") for block in raw_content if isinstance(block, dict) and "text" in block])
+    return str(raw_content)
+
+
+def _decode_to_pcm(data: bytes) -> bytes:
+    """Decode uploaded audio (webm/ogg/...) to 16 kHz mono s16 PCM in-process.
+
+    Replaces the pydub path, which forked an ffmpeg subprocess and bounced the
+    audio through two temp files on every request.
+    """
+    resampler = av.AudioResampler(format='s16', layout='mono', rate=16000)
+    pcm = bytearray()
+    with av.open(io.BytesIO(data)) as container:
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                pcm.extend(out.to_ndarray().tobytes())
+    for out in resampler.resample(None):  # flush
+        pcm.extend(out.to_ndarray().tobytes())
+    return bytes(pcm)
+
+
+def _tts_bytes(text: str) -> bytes:
+    """Blocking TTS synthesis straight into memory (no temp file)."""
+    buf = io.BytesIO()
+    if _piper is not None:
+        # PiperVoice writes frames through the wave module, not a raw buffer.
+        with wave.open(buf, "wb") as wf:
+            _piper.synthesize(text, wf)
+    else:
+        gTTS(text=text, lang='en', tld='co.in').write_to_fp(buf)
+    return buf.getvalue()
+
 # ==========================================
 # 🌐 PIPELINE 1: BROWSER WEB UI ENDPOINT
 # ==========================================
@@ -52,52 +120,63 @@ async def chat_endpoint(
     session_id: str = Form("default_user_1")
 ):
     try:
-        # 1. Save incoming browser audio (usually .webm)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as tmp_in:
-            tmp_in.write(await audio_file.read())
-            input_audio_path = tmp_in.name
-
-        # 2. Transcode to pure WAV using pydub
-        wav_audio_path = input_audio_path + ".wav"
-        audio = AudioSegment.from_file(input_audio_path)
-        audio.export(wav_audio_path, format="wav")
-
-        # 3. Speech-to-Text
-        recognizer = sr.Recognizer()
-        with sr.AudioFile(wav_audio_path) as source:
-            audio_data = recognizer.record(source)
-            user_text = recognizer.recognize_google(audio_data) 
-            logger.info(f"User Transcribed: {user_text}")
-
-        # 4. Process with LangGraph & Gemini
+        # 1. Decode incoming browser audio (usually .webm) straight to PCM
+        # in memory — no ffmpeg fork, no temp files.
+        pcm = await asyncio.to_thread(_decode_to_pcm, await audio_file.read())
+
+        # 2. Speech-to-Text on the raw PCM buffer; the Google STT round-trip
+        # is blocking, so keep it off the event loop.
+        audio_data = sr.AudioData(pcm, 16000, 2)
+        user_text = await asyncio.to_thread(_recognizer.recognize_google, audio_data)
+        logger.info(f"User Transcribed: {user_text}")
+
+        # 3. Process with LangGraph & Gemini, piping synthesizer tokens into
+        # TTS sentence-by-sentence: the first MP3 chunk goes out while the
+        # LLM is still generating the rest of the reply.
         inputs = {"messages": [HumanMessage(content=user_text)]}
-        config = {"configurable": {"thread_id": session_id}} 
-        result = agent_graph.invoke(inputs, config=config)
+        config = {"configurable": {"thread_id": session_id}}
 
-        # Extract the raw content safely
-        raw_content = result["messages"][-1].content
-        if isinstance(raw_content, list):
-            final_message = "".join([block.get("text", "") for block in raw_content if isinstance(block, dict) and "text" in block])
-        else:
-            final_message = str(raw_content)
-            
-        logger.info(f"Loop AI: {final_message}")
+        async def audio_stream():
+            pending = ""
+            spoken = ""
+            async for event in agent_graph.astream_events(inputs, config=config, version="v2"):
+                if event["event"] != "on_chat_model_stream":
+                    continue
+                # Only the synthesizer speaks; router/SQL tokens stay internal.
+                if event.get("metadata", {}).get("langgraph_node") != "synthesize":
+                    continue
+                pending += _msg_text(event["data"]["chunk"].content)
+                *done, pending = SENTENCE_SPLIT_RE.split(pending)
+                for sentence in done:
+                    if sentence.strip():
+                        spoken += sentence + " "
+                        # MP3 frames concatenate cleanly, so gTTS can speak
+                        # sentence-by-sentence. WAV cannot — the player stops
+                        # at the first RIFF header — so the piper path buffers
+                        # the text and speaks the whole reply in one file below.
+                        if _piper is None:
+                            yield await asyncio.to_thread(_tts_bytes, sentence.strip())
+            if pending.strip():
+                spoken += pending
+                if _piper is None:
+                    yield await asyncio.to_thread(_tts_bytes, pending.strip())
 
-        # 5. Text-to-Speech (TTS)
-        tts = gTTS(text=final_message, lang='en', tld='co.in')
-        output_audio_path = tempfile.mktemp(suffix=".mp3")
-        tts.save(output_audio_path)
+            if not spoken:
+                # Direct replies (greeting/reject/handoff/failure) don't stream
+                # through the synthesizer; read the final message back from the
+                # checkpoint and speak it in one shot.
+                snapshot = await agent_graph.aget_state(config)
+                spoken = _msg_text(snapshot.values["messages"][-1].content)
+                if _piper is None:
+                    yield await asyncio.to_thread(_tts_bytes, spoken)
+
+            if _piper is not None and spoken.strip():
+                yield await asyncio.to_thread(_tts_bytes, spoken.strip())
+
+            logger.info(f"Loop AI: {spoken.strip()}")
+
+        return StreamingResponse(audio_stream(), media_type=_TTS_MEDIA_TYPE)
 
-        # 6. Clean up temp files
-        os.remove(input_audio_path)
-        os.remove(wav_audio_path)
-        
-        return FileResponse(
-            path=output_audio_path, 
-            media_type="audio/mpeg", 
-            filename="response.mp3"
-        )
-        
     except Exception as e:
         logger.error(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))  
@@ -149,14 +228,13 @@ async def process_speech(request: Request):
     inputs = {"messages": [HumanMessage(content=speech_result)]}
     
     try:
-        result = agent_graph.invoke(inputs, config=config)
-        
-        raw_content = result["messages"][-1].content
-        if isinstance(raw_content, list):
-            ai_message = "".join([block.get("text", "") for block in raw_content if isinstance(block, dict) and "text" in block])
-        else:
-            ai_message = str(raw_content)
-            
+        # TwiML is a one-shot document: <Say> needs the complete reply before
+        # we can answer Twilio, so unlike /chat there is nothing to gain from
+        # forwarding partial tokens here — one ainvoke is the fastest shape.
+        result = await agent_graph.ainvoke(inputs, config=config)
+        ai_message = _msg_text(result["messages"][-1].content)
+
+
         logger.info(f"\n[TELEPHONY] 🤖 Loop AI Output: {ai_message}")
         
         # 3A. The Exact Assignment Requirement (Out of scope -> Hang up)
@@ -9,9 +9,72 @@ def setup_database(csv_path="hospitals.csv"):
     """Reads the large CSV and creates a lightweight, searchable SQL database."""
     df = pd.read_csv(csv_path)
     df = df.fillna("Unknown") # Prevent null errors
-    
+
+    # Normalized search columns: lowercasing once at ingest means queries can
+    # do an index-assisted `city_norm LIKE 'keyword%'` prefix match instead of
+    # a COLLATE NOCASE scan, and folding the Bengaluru alias here removes the
+    # `CITY LIKE ... OR CITY LIKE ...` double scan per city query.
+    df["city_norm"] = df["CITY"].str.lower().str.replace("bengaluru", "bangalore", regex=False)
+    df["name_norm"] = df["HOSPITAL NAME"].str.lower()
+
     conn = sqlite3.connect("data/hospitals.db")
-    # Load into a table called 'hospitals'
-    df.to_sql("hospitals", conn, if_exists="replace", index=False)
+
+    # Bulk ingest into a table called 'hospitals'. df.to_sql inserts row by
+    # row with per-statement overhead; one executemany inside a single
+    # journal-less transaction is an order of magnitude faster on multi-MB
+    # CSVs. Safe here: this is one-time cold-start work on a throwaway file,
+    # so a failed run just re-ingests.
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    col_defs = ", ".join('"{}" TEXT'.format(c) for c in df.columns)
+    placeholders = ", ".join("?" for _ in df.columns)
+    conn.execute("DROP TABLE IF EXISTS hospitals")
+    conn.execute(f"CREATE TABLE hospitals ({col_defs})")
+    conn.execute("BEGIN")
+    conn.executemany(f"INSERT INTO hospitals VALUES ({placeholders})",
+                     df.itertuples(index=False, name=None))
+    conn.commit()
+
+    # Case-insensitive B-tree indexes: the repair path still emits LIKE /
+    # equality filters on these columns, and prefix LIKEs can use them.
+    conn.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_city ON hospitals("CITY" COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS idx_name ON hospitals("HOSPITAL NAME" COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS idx_city_norm ON hospitals(city_norm);
+        CREATE INDEX IF NOT EXISTS idx_name_norm ON hospitals(name_norm);
+    """)
+
+    # Full-text index: the agent's fuzzy searches used leading-wildcard LIKE,
+    # which forces a full table scan on every query. FTS5 serves tokenized
+    # word searches in O(log N) regardless of catalog size.
+    conn.executescript("""
+        DROP TABLE IF EXISTS hospitals_fts;
+        CREATE VIRTUAL TABLE hospitals_fts USING fts5(
+            "HOSPITAL NAME", Address, CITY,
+            tokenize='unicode61 remove_diacritics 2',
+            content='hospitals', content_rowid='rowid'
+        );
+        INSERT INTO hospitals_fts(hospitals_fts) VALUES('rebuild');
+    """)
     conn.close()
-    print("Database successfully loaded into SQLite!")
\ No newline at end of file
+    print("Database successfully loaded into SQLite!")
+
+
+def database_is_current(db_path="data/hospitals.db"):
+    """True when the on-disk DB matches the schema the SQL prompts rely on.
+
+    The prompts hard-require the normalized columns and the FTS index, so a
+    database built by an older ingest must be rebuilt — otherwise every
+    search targets columns/tables that don't exist.
+    """
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            cols = {row[1] for row in conn.execute("PRAGMA table_info(hospitals)")}
+            tables = {row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")}
+            return {"city_norm", "name_norm"} <= cols and "hospitals_fts" in tables
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
\ No newline at end of file